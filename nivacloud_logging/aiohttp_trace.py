@@ -9,15 +9,15 @@ def create_client_trace_config():
     """
 
     async def on_request_start(session, trace_config_ctx, params):
-        params.headers["Span-Id"] = (
-            LogContext.getcontext("span_id") or generate_trace_id()
-        )
-        trace_id = LogContext.getcontext("trace_id")
+        context = LogContext.getcontext()
+        headers = params.headers
+        headers["Span-Id"] = context.get("span_id") or generate_trace_id()
+        trace_id = context.get("trace_id")
         if trace_id:
-            params.headers["Trace-Id"] = trace_id
-        user_id = LogContext.getcontext("user_id")
+            headers["Trace-Id"] = trace_id
+        user_id = context.get("user_id")
         if user_id:
-            params.headers["User-Id"] = user_id
+            headers["User-Id"] = user_id
 
     trace_config = aiohttp.TraceConfig()
     trace_config.on_request_start.append(on_request_start)
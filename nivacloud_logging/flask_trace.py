@@ -3,6 +3,8 @@ import time
 
 from nivacloud_logging.log_utils import LogContext, generate_trace_id
 
+_logger = logging.getLogger(__name__)
+
 
 class TracingMiddleware:
     """
@@ -18,31 +20,37 @@ class TracingMiddleware:
         self.app = app
 
     def __call__(self, environ, start_response):
-        def execute_traced_request():
-            t0 = time.monotonic()
-            r = self.app(environ, start_response)
-            elapsed = time.monotonic() - t0
-            logging.info(
-                f"{environ.get('REQUEST_METHOD')} {environ.get('RAW_URI')} "
-                f"{environ.get('SERVER_PROTOCOL')} from {environ.get('REMOTE_ADDR')}",
-                extra={
-                    "elapsed_s": elapsed,
-                    "raw_uri": environ.get("RAW_URI"),
-                    "remote_addr": environ.get("REMOTE_ADDR"),
-                    "server_protocol": environ.get("SERVER_PROTOCOL"),
-                },
-            )
-            return r
-
-        contextvars = {
-            "trace_id": environ.get("HTTP_TRACE_ID") or generate_trace_id(),
-            "user_id": environ.get("HTTP_USER_ID"),
-            "span_id": environ.get("HTTP_SPAN_ID") or generate_trace_id(),
-        }
-
+        get = environ.get
         contextvars_with_values = {
-            k: v for k, v in contextvars.items() if v is not None
+            "trace_id": get("HTTP_TRACE_ID") or generate_trace_id(),
+            "span_id": get("HTTP_SPAN_ID") or generate_trace_id(),
         }
+        user_id = get("HTTP_USER_ID")
+        if user_id is not None:
+            contextvars_with_values["user_id"] = user_id
 
-        with LogContext(**contextvars_with_values):
-            return execute_traced_request()
+        token = LogContext.enter_request(**contextvars_with_values)
+        try:
+            t0 = time.perf_counter()
+            r = self.app(environ, start_response)
+            elapsed = time.perf_counter() - t0
+            if _logger.isEnabledFor(logging.INFO):
+                raw_uri = get("RAW_URI")
+                remote_addr = get("REMOTE_ADDR")
+                server_protocol = get("SERVER_PROTOCOL")
+                _logger.info(
+                    "%s %s %s from %s",
+                    get("REQUEST_METHOD"),
+                    raw_uri,
+                    server_protocol,
+                    remote_addr,
+                    extra={
+                        "elapsed_s": elapsed,
+                        "raw_uri": raw_uri,
+                        "remote_addr": remote_addr,
+                        "server_protocol": server_protocol,
+                    },
+                )
+            return r
+        finally:
+            LogContext.exit_request(token)
@@ -1,5 +1,60 @@
+import functools
+import json
+import math
+import re
+from enum import Enum
+from time import gmtime, strftime
+from uuid import UUID
+
 from pythonjsonlogger import jsonlogger
 
+try:
+    import orjson
+except ImportError:
+    # orjson is optional, we fall back to the standard json module without it.
+    orjson = None
+
+# What json.dumps() escapes with ensure_ascii, other than control characters.
+_NON_ASCII_RE = re.compile("[\x7f-\U0010ffff]")
+
+
+def _escape_non_ascii(match):
+    n = ord(match.group())
+    if n < 0x10000:
+        return "\\u%04x" % n
+    # (As a UTF-16 surrogate pair.)
+    n -= 0x10000
+    return "\\u%04x\\u%04x" % (0xD800 | (n >> 10), 0xDC00 | (n & 0x3FF))
+
+
+_SCALAR_TYPES = frozenset({str, int, float, bool, type(None)})
+
+
+def _contains_enum_or_uuid(values, depth=0):
+    """Whether any of the values is or contains an Enum member or UUID. orjson
+    serializes those itself instead of calling default(), unlike json."""
+    for v in values:
+        if type(v) in _SCALAR_TYPES:
+            continue
+        elif isinstance(v, dict):
+            # (orjson gives up at this depth anyway.)
+            if depth > 254 or _contains_enum_or_uuid(v.values(), depth + 1):
+                return True
+        elif isinstance(v, (list, tuple)):
+            if depth > 254 or _contains_enum_or_uuid(v, depth + 1):
+                return True
+        elif isinstance(v, (Enum, UUID)):
+            return True
+    return False
+
+
+def _orjson_default(default, o):
+    result = default(o)
+    if _contains_enum_or_uuid((result,)):
+        # Makes orjson.dumps() fail, so that json is used instead.
+        raise TypeError("Unsupported by orjson")
+    return result
+
 
 class StackdriverJsonFormatter(jsonlogger.JsonFormatter, object):
     """
@@ -9,8 +64,19 @@ class StackdriverJsonFormatter(jsonlogger.JsonFormatter, object):
 
     maps levelname to severity as this is the format used by google stackdriver
 
+    If orjson is installed, it is used to serialize log records, unless a custom
+    json_encoder is given. The output parses to the same values either way, except
+    that orjson outputs NaN and infinity as null, since those aren't valid JSON. It
+    doesn't output spaces after separators, though, and formats some floats
+    differently, e.g. 1e16 rather than 1e+16. (Records with Enum members or UUIDs
+    are serialized with json, since orjson serializes those differently.)
+
+    The timestamp is the time the record was created, in UTC, formatted like
+    datetime.isoformat() (which python-json-logger would have output for it).
     """
 
+    _cached_timestamp_second = (None, None)
+
     def __init__(
         self,
         fmt="%(levelname) %(message) %(funcName) %(module) %(filename) %(lineno) %(thread) %(process)",
@@ -19,8 +85,80 @@ class StackdriverJsonFormatter(jsonlogger.JsonFormatter, object):
         **kwargs
     ):
         jsonlogger.JsonFormatter.__init__(self, fmt=fmt, *args, **kwargs)
+        # json.dumps() creates a new encoder on every call when given options, so
+        # keep one for when orjson isn't available.
+        self._json_fallback_encoder = (self.json_encoder or json.JSONEncoder)(
+            default=self.json_default, ensure_ascii=self.json_ensure_ascii
+        )
+        # orjson can only stand in for the standard encoders, with the same default.
+        self._orjson_default = None
+        if self.json_encoder in (None, jsonlogger.JsonEncoder):
+            self._orjson_default = functools.partial(
+                _orjson_default, self._json_fallback_encoder.default
+            )
+
+    def add_fields(self, log_record, record, message_dict):
+        # Like JsonFormatter.add_fields(), but with the timestamp from the record
+        # rather than datetime.utcnow(), so that it's correct when queued as well.
+        for field in self._required_fields:
+            log_record[field] = record.__dict__.get(field)
+        log_record.update(message_dict)
+        jsonlogger.merge_record_extra(record, log_record, reserved=self._skip_fields)
+
+        if self.timestamp:
+            key = self.timestamp if type(self.timestamp) == str else "timestamp"
+            log_record[key] = self.format_timestamp(record.created)
+
+    def format_timestamp(self, created):
+        """Same as datetime.utcfromtimestamp(created).isoformat(), but only formats
+        the date and time part once per second."""
+        # (Rounds microseconds the same way as datetime.utcfromtimestamp().)
+        (fraction, second) = math.modf(created)
+        microsecond = round(fraction * 1e6)
+        if microsecond >= 1000000:
+            second += 1
+            microsecond -= 1000000
+        second = int(second)
+
+        # (A single tuple, so other threads never see a mismatched second and string.)
+        (cached_second, formatted) = self._cached_timestamp_second
+        if cached_second != second:
+            formatted = strftime("%Y-%m-%dT%H:%M:%S", gmtime(second))
+            self._cached_timestamp_second = (second, formatted)
+
+        if microsecond:
+            return "%s.%06d" % (formatted, microsecond)
+        return formatted
 
     def process_log_record(self, log_record):
-        log_record["severity"] = log_record["levelname"]
-        del log_record["levelname"]
+        log_record["severity"] = log_record.pop("levelname")
         return super(StackdriverJsonFormatter, self).process_log_record(log_record)
+
+    def jsonify_log_record(self, log_record):
+        if self.json_serializer is not json.dumps or self.json_indent is not None:
+            return super().jsonify_log_record(log_record)
+
+        if (
+            orjson is not None
+            and self._orjson_default is not None
+            and not _contains_enum_or_uuid(log_record.values())
+        ):
+            try:
+                s = orjson.dumps(
+                    log_record,
+                    default=self._orjson_default,
+                    option=orjson.OPT_NON_STR_KEYS
+                    | orjson.OPT_PASSTHROUGH_DATACLASS
+                    | orjson.OPT_PASSTHROUGH_DATETIME,
+                ).decode()
+            except orjson.JSONEncodeError:
+                # E.g. integers that don't fit in 64 bits, which json handles fine.
+                # (Or default() returning a value that orjson serializes differently.)
+                pass
+            else:
+                if self.json_ensure_ascii:
+                    # (Non-ASCII characters can only be in strings, so this is safe.)
+                    s = _NON_ASCII_RE.sub(_escape_non_ascii, s)
+                return s
+
+        return self._json_fallback_encoder.encode(log_record)
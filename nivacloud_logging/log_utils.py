@@ -1,14 +1,19 @@
+import atexit
+import copy
 import functools
 import inspect
 import json
 import logging
 import os
-import random
+import queue
 import signal
 import sys
 import threading
+from contextvars import ContextVar, Token, copy_context
 from datetime import datetime, date, time
 from logging import StreamHandler, Formatter
+from logging.handlers import QueueHandler, QueueListener
+from time import strftime
 
 from nivacloud_logging.json_formatter import StackdriverJsonFormatter
 
@@ -24,13 +29,21 @@ class LogContext:
             logging.error("Something really bad happened!")
     """
 
-    __context = threading.local()
+    # Instances are created for every with block, so don't give them a __dict__.
+    __slots__ = ("context_values", "previous_tokens")
+
+    __context = ContextVar("nivacloud_log_context", default={})
+    # Plaintext representations of the values in __context, set lazily by
+    # iter_context_plaintext() the first time a record is logged in a context.
+    __plaintext_context = ContextVar("nivacloud_log_context_plaintext", default={})
     __default_context = {}
+    # (The defaults dict that was encoded, and its encoded values, as one tuple.)
+    __plaintext_default_context = (None, {})
     __default_context_lock = threading.Lock()
 
     def __init__(self, **context_values):
         self.context_values = context_values
-        self.previous_values = {}
+        self.previous_tokens = []
 
     async def __aenter__(self):
         self._enter_context()
@@ -47,34 +60,137 @@ class LogContext:
         self._exit_context()
 
     def _enter_context(self):
-        for ctx_key, ctx_value in self.context_values.items():
-            self.previous_values[ctx_key] = getattr(self.__context, ctx_key, None)
-            setattr(self.__context, ctx_key, ctx_value)
+        # (Not via enter_request(), which can't take a context key named "cls".)
+        self.previous_tokens.append(self._enter_values(self.context_values))
 
     def _exit_context(self):
-        for ctx_key in self.context_values.keys():
-            previous = self.previous_values[ctx_key]
-            if previous is None:
-                delattr(self.__context, ctx_key)
-            else:
-                setattr(self.__context, ctx_key, previous)
+        self.exit_request(self.previous_tokens.pop())
+
+    @classmethod
+    def enter_request(cls, **context_values):
+        """
+        Enter a context with the given context_values without creating a LogContext
+        instance, for hot paths like request middlewares. Returns a token that must
+        be passed to exit_request() afterwards, preferably in a finally block.
+        """
+        # (context_values is always a fresh dict, so it can be stored as it is.)
+        return cls._enter_values(context_values)
+
+    @classmethod
+    def _enter_values(cls, context_values):
+        # The stored dict is never mutated, only replaced, so readers don't need a
+        # lock. Callers must not mutate context_values afterwards either.
+        context = cls.__context.get()
+        if context:
+            context = {**context, **context_values}
+        else:
+            context = context_values
+
+        plaintext_context = cls.__plaintext_context.get()
+        if plaintext_context:
+            plaintext_context = {
+                k: v
+                for (k, v) in plaintext_context.items()
+                if k not in context_values
+            }
+        else:
+            plaintext_context = {}
+
+        return (
+            cls.__context.set(context),
+            cls.__plaintext_context.set(plaintext_context),
+        )
+
+    @classmethod
+    def exit_request(cls, token):
+        """Restore the context that was active before the matching enter_request()."""
+        (context_token, plaintext_token) = token
+        try:
+            cls.__plaintext_context.reset(plaintext_token)
+            cls.__context.reset(context_token)
+        except ValueError:
+            # Entered in another Context, e.g. by an async generator that was
+            # resumed in another task. Restore the previous values anyway, like
+            # when the context was thread-local.
+            for (var, var_token) in (
+                (cls.__plaintext_context, plaintext_token),
+                (cls.__context, context_token),
+            ):
+                old_value = var_token.old_value
+                var.set({} if old_value is Token.MISSING else old_value)
 
     @classmethod
     def getcontext(cls, key=None):
-        """Returns the thread-local value for given key or a default global value
+        """Returns the context-local value for given key or a default global value
         if it doesn't exist. Returns the whole context if no key is given."""
-        with cls.__default_context_lock:
-            if key is None:
-                return {**cls.__default_context, **cls.__context.__dict__}
+        if key is None:
+            return {**cls.__default_context, **cls.__context.get()}
+        else:
+            return cls.__context.get().get(key, cls.__default_context.get(key))
+
+    @classmethod
+    def iter_context(cls):
+        """Iterates over the (key, value) pairs of the whole context, in the same
+        order as getcontext().items(), but without building a merged dict."""
+        context = cls.__context.get()
+        defaults = cls.__default_context
+        if not defaults:
+            return context.items()
+        elif not context:
+            return defaults.items()
+        else:
+            return cls._iter_merged(defaults, context, context)
+
+    @classmethod
+    def iter_context_plaintext(cls):
+        """Like iter_context(), but with every value in its plaintext (JSON)
+        representation. Each value is only encoded once per context, no matter
+        how many records are logged within it."""
+        context = cls.__context.get()
+        plaintext_context = cls.__plaintext_context.get()
+        if len(plaintext_context) != len(context):
+            # Replaced rather than filled in, since copies of this context (e.g. from
+            # bind_log_context()) share the dict and may be in use on other threads.
+            plaintext_context = {
+                k: plaintext_context[k]
+                if k in plaintext_context
+                else _plaintext_repr(v)
+                for (k, v) in context.items()
+            }
+            cls.__plaintext_context.set(plaintext_context)
+
+        # (set_default() replaces the defaults dict, so this is stale if it's not
+        # the same dict, even if another thread encoded it just now.)
+        defaults = cls.__default_context
+        (encoded_defaults, plaintext_defaults) = cls.__plaintext_default_context
+        if encoded_defaults is not defaults:
+            plaintext_defaults = {k: _plaintext_repr(v) for (k, v) in defaults.items()}
+            cls.__plaintext_default_context = (defaults, plaintext_defaults)
+
+        if not context:
+            return plaintext_defaults.items()
+        # (In the order of context, like iter_context().)
+        return cls._iter_merged(plaintext_defaults, context, plaintext_context)
+
+    @staticmethod
+    def _iter_merged(defaults, context, values):
+        """Yields the items of {**defaults, **context}, in that order, but with
+        the values for keys in context taken from values."""
+        for (k, v) in defaults.items():
+            if k in context:
+                yield (k, values[k])
             else:
-                return cls.__context.__dict__.get(key, cls.__default_context.get(key))
+                yield (k, v)
+        for k in context:
+            if k not in defaults:
+                yield (k, values[k])
 
     @classmethod
     def set_default(cls, key, value):
-        """Set global default value for given key. Shared by all threads. These are used
-        when no thread-local value is available for given key."""
+        """Set global default value for given key. Shared by all threads and tasks.
+        These are used when no context-local value is available for given key."""
         with cls.__default_context_lock:
-            cls.__default_context[key] = value
+            cls.__default_context = {**cls.__default_context, key: value}
 
     @classmethod
     def reset_defaults(cls):
@@ -118,14 +234,42 @@ def log_context(**ctxargs):
     def metawrap(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            with LogContext(**ctxargs):
+            # The token is local to each call, so this is safe to share between
+            # threads and tasks, unlike a single LogContext instance would be.
+            # (ctxargs is never mutated, so it's passed on without unpacking.)
+            token = LogContext._enter_values(ctxargs)
+            try:
                 return func(*args, **kwargs)
+            finally:
+                LogContext.exit_request(token)
 
         return wrapper
 
     return metawrap
 
 
+def bind_log_context(func):
+    """
+    Returns a function that calls func with the log context that is active now,
+    for running it on another thread. (New threads, including the ones in
+    thread pools, otherwise start out without any log context.)
+
+    Sample usage:
+        with LogContext(trace_id=trace_id):
+            executor.submit(bind_log_context(xyzzy), x)
+    """
+    # (This copies all context variables, like asyncio does for new tasks.)
+    context = copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # A Context can only be entered by one thread at a time, so each call
+        # gets its own copy, like if the wrapper is passed to executor.map().
+        return context.copy().run(func, *args, **kwargs)
+
+    return wrapper
+
+
 def auto_context(*context_args: str):
     """
     Automatically generate a context for the function it wraps consisting of the parameter names
@@ -146,20 +290,92 @@ def auto_context(*context_args: str):
 
     def meta_wrap(func):
         signature = inspect.signature(func)
+        parameters = signature.parameters.values()
         included_args = set(signature.parameters.keys()) - {"self"}
         if context_args:
             included_args &= set(context_args)
 
-        @functools.wraps(func)
-        def auto_ctx_wrapper(*args, **kwargs):
-            bound_args = signature.bind(*args, **kwargs)
-            bound_args.apply_defaults()
-            log_params = {
-                k: v for (k, v) in bound_args.arguments.items() if k in included_args
-            }
-
-            with LogContext(**log_params):
-                return func(*args, **kwargs)
+        if any(p.kind == p.VAR_KEYWORD for p in parameters):
+
+            @functools.wraps(func)
+            def auto_ctx_wrapper(*args, **kwargs):
+                bound_args = signature.bind(*args, **kwargs)
+                bound_args.apply_defaults()
+                log_params = {
+                    k: v
+                    for (k, v) in bound_args.arguments.items()
+                    if k in included_args
+                }
+
+                token = LogContext._enter_values(log_params)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    LogContext.exit_request(token)
+
+        else:
+            # Signature.bind() is slow, so without **kwargs we look up the included
+            # arguments directly by position or name instead. (Parameters come in
+            # the order positional, *args, keyword-only, and so does the context.)
+            positional = [
+                p
+                for p in parameters
+                if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)
+            ]
+            positional_count = len(positional)
+            lookups = [
+                (p.name, i, p.default)
+                for (i, p) in enumerate(positional)
+                if p.name in included_args
+            ]
+            varargs = [p.name for p in parameters if p.kind == p.VAR_POSITIONAL]
+            has_varargs = bool(varargs)
+            varargs_name = None
+            if varargs and varargs[0] in included_args:
+                varargs_name = varargs[0]
+            keyword_lookups = [
+                (p.name, p.default)
+                for p in parameters
+                if p.kind == p.KEYWORD_ONLY and p.name in included_args
+            ]
+
+            @functools.wraps(func)
+            def auto_ctx_wrapper(*args, **kwargs):
+                # When every parameter is passed positionally (the common case), the
+                # context can be picked straight out of args by precomputed index.
+                if (
+                    not kwargs
+                    and not keyword_lookups
+                    and len(args) >= positional_count
+                    and (has_varargs or len(args) == positional_count)
+                ):
+                    log_params = {name: args[i] for (name, i, _) in lookups}
+                    if varargs_name is not None:
+                        log_params[varargs_name] = args[positional_count:]
+                else:
+                    log_params = {}
+                    for (name, position, default) in lookups:
+                        if position < len(args):
+                            log_params[name] = args[position]
+                        elif name in kwargs:
+                            log_params[name] = kwargs[name]
+                        elif default is not inspect.Parameter.empty:
+                            log_params[name] = default
+                    if varargs_name is not None:
+                        log_params[varargs_name] = args[positional_count:]
+                    for (name, default) in keyword_lookups:
+                        if name in kwargs:
+                            log_params[name] = kwargs[name]
+                        elif default is not inspect.Parameter.empty:
+                            log_params[name] = default
+
+                # (log_params is a fresh dict, so it's passed on without unpacking,
+                # and without creating a LogContext per call, like log_context.)
+                token = LogContext._enter_values(log_params)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    LogContext.exit_request(token)
 
         return auto_ctx_wrapper
 
@@ -168,10 +384,11 @@ def auto_context(*context_args: str):
 
 def generate_trace_id():
     """
-    Create a random number formatted as a hexadecimal string, suitable for use
-    as a trace identifier.
+    Create a random 128-bit number formatted as a 32 character hexadecimal
+    string, suitable for use as a trace identifier.
     """
-    return f"{random.randint(0, 2 ** 128 - 1):x}"
+    # Same as secrets.token_hex(16), without the extra function calls.
+    return os.urandom(16).hex()
 
 
 def _global_exception_handler(exc_type, value, traceback):
@@ -179,10 +396,31 @@ def _global_exception_handler(exc_type, value, traceback):
     Intended used as a monkeypatch of sys.excepthook in order to log exceptions.
 
     Taken from https://stackoverflow.com/questions/6234405/logging-uncaught-exceptions-in-python
+
+    The record is made directly rather than via logging.exception(), so that it
+    refers to where the exception was raised instead of to this function.
     """
-    logging.exception(
-        f"Uncaught exception {exc_type.__name__}: {value}",
-        exc_info=(exc_type, value, traceback),
+    if traceback is not None:
+        innermost = traceback
+        while innermost.tb_next is not None:
+            innermost = innermost.tb_next
+        code = innermost.tb_frame.f_code
+        (filename, lineno, func) = (code.co_filename, innermost.tb_lineno, code.co_name)
+    else:
+        (filename, lineno, func) = ("(unknown file)", 0, "(unknown function)")
+
+    root_logger = logging.getLogger()
+    root_logger.handle(
+        root_logger.makeRecord(
+            root_logger.name,
+            logging.ERROR,
+            filename,
+            lineno,
+            f"Uncaught exception {exc_type.__name__}: {value}",
+            (),
+            (exc_type, value, traceback),
+            func,
+        )
     )
 
 
@@ -190,18 +428,24 @@ def _loglevel_signal_handler(loggers):
     """
     Handle SIGUSR1 and SIGUSR2. Sets log level to INFO on SIGUSR1 and DEBUG on SIGUSR2.
 
-    After setting level, it calls the previous SIGUSRx handler unless it was set to SIG_DFL.
+    After setting level, it calls the previous SIGUSRx handler unless it was set to SIG_DFL
+    or SIG_IGN.
     """
     usr_signals = {
         signal.SIGUSR1: logging.INFO,
         signal.SIGUSR2: logging.DEBUG,
     }
 
-    previous_handlers = {
-        signalnum: handler
-        for (signalnum, handler) in zip(usr_signals, map(signal.getsignal, usr_signals))
-        if handler != signal.SIG_DFL
-    }
+    previous_handlers = {}
+    for signalnum in usr_signals:
+        handler = signal.getsignal(signalnum)
+        # Chain to what was there before our handler from an earlier setup_logging()
+        # call, instead of to that handler, so that repeated setups don't build up a
+        # chain of handlers setting the levels of handlers that have been removed.
+        handler = getattr(handler, "previous_handlers", {}).get(signalnum, handler)
+        # (Skips SIG_DFL and SIG_IGN, and None for handlers not set from Python.)
+        if callable(handler) and not hasattr(handler, "previous_handlers"):
+            previous_handlers[signalnum] = handler
 
     def handle_usr_signal(signalnum, _frame):
         level = usr_signals[signalnum]
@@ -212,6 +456,8 @@ def _loglevel_signal_handler(loggers):
         if previous_handler:
             previous_handler(signalnum, _frame)
 
+    handle_usr_signal.previous_handlers = previous_handlers
+
     signal.signal(signal.SIGUSR1, handle_usr_signal)
     signal.signal(signal.SIGUSR2, handle_usr_signal)
 
@@ -225,25 +471,64 @@ def json_default(o):
         return str(o)
 
 
+# json.dumps() creates a new encoder on every call when given options, so keep one.
+_plaintext_encoder = json.JSONEncoder(default=json_default, sort_keys=True)
+
+
+def _plaintext_repr(o):
+    if type(o) is int:
+        return str(o)
+    return _plaintext_encoder.encode(o)
+
+
 class _LogContextHandler(StreamHandler):
-    pass
+    """
+    A stream handler whose records get the log context added by a context
+    filter. (The filter is added to the handler that receives records from the
+    loggers, which is a _LogContextQueueHandler in front of this one if queued.)
+    """
+
+    # Set when queued: The listener thread then flushes the stream whenever it
+    # has emitted all queued records, instead of after each record, so a burst
+    # of log entries doesn't take one write to the stream per entry.
+    defer_flush = False
+
+    def flush(self):
+        if not self.defer_flush:
+            super().flush()
 
+    def flush_deferred(self):
+        super().flush()
 
-class _StructuredLogContextHandler(_LogContextHandler):
-    def handle(self, record):
-        for (k, v) in LogContext.getcontext().items():
-            if not hasattr(record, k):
-                setattr(record, k, v)
 
-        return super().handle(record)
+class _FlushingQueueListener(QueueListener):
+    def dequeue(self, block):
+        if block and self.queue.empty():
+            for handler in self.handlers:
+                handler.flush_deferred()
+        return super().dequeue(block)
 
 
-class _PlaintextLogContextHandler(_LogContextHandler):
-    # From Python docs via jsonlogger.py:
-    # http://docs.python.org/library/logging.html#logrecord-attributes
-    RESERVED_ATTRS = {
+class _StructuredContextFilter(logging.Filter):
+    def filter(self, record):
+        # Handler filters only run for records at or above the handler level,
+        # on the thread (or task) that logged them, so context is only added to
+        # records that will be output, and it's the context of the caller.
+        record_dict = record.__dict__
+        for (k, v) in LogContext.iter_context():
+            record_dict.setdefault(k, v)
+        return True
+
+
+# From Python docs via jsonlogger.py:
+# http://docs.python.org/library/logging.html#logrecord-attributes
+# (Plus "context", which is set by _PlaintextContextFilter itself, and
+# "taskName", which was added in Python 3.12.)
+_RESERVED_ATTRS = frozenset(
+    {
         "args",
         "asctime",
+        "context",
         "created",
         "exc_info",
         "exc_text",
@@ -262,30 +547,109 @@ class _PlaintextLogContextHandler(_LogContextHandler):
         "processName",
         "relativeCreated",
         "stack_info",
+        "taskName",
         "thread",
         "threadName",
     }
+)
+
+
+class _PlaintextContextFilter(logging.Filter):
+    def filter(self, record):
+        # Record attributes (i.e. extras) override context values, so the two
+        # lists never have keys in common, and don't need to be merged in a dict.
+        record_dict = record.__dict__
+        formatted_ctx = [
+            f"{k}={v}"
+            for (k, v) in LogContext.iter_context_plaintext()
+            if k not in record_dict
+        ]
+        plain_repr = self.plain_repr
+        formatted_ctx.extend(
+            [
+                f"{k}={plain_repr(v)}"
+                for (k, v) in record_dict.items()
+                if k not in _RESERVED_ATTRS and k[:1] != "_"
+            ]
+        )
 
-    def handle(self, record):
-        ctx = {
-            k: v for (k, v) in LogContext.getcontext().items() if not hasattr(record, k)
-        }
+        if formatted_ctx:
+            record.context = f" [{', '.join(formatted_ctx)}]"
+        else:
+            record.context = ""
+        return True
 
-        for key, value in record.__dict__.items():
-            if (
-                key not in self.RESERVED_ATTRS
-                and not key.startswith("_")
-                and key != "context"
-            ):
-                ctx[key] = value
+    plain_repr = staticmethod(_plaintext_repr)
 
-        formatted_ctx = [f"{k}={self.plain_repr(v)}" for (k, v) in ctx.items()]
-        record.context = (" [" + ", ".join(formatted_ctx) + "]") if ctx else ""
-        return super().handle(record)
 
-    @staticmethod
-    def plain_repr(o):
-        return json.dumps(o, default=json_default, sort_keys=True)
+# (queue.SimpleQueue is new in Python 3.7.)
+_SimpleQueue = getattr(queue, "SimpleQueue", queue.Queue)
+
+
+class _LogContextQueueHandler(QueueHandler):
+    """
+    Puts records on a queue, from which a QueueListener thread passes them on to
+    the given log context handler, so that formatting and writing logs doesn't
+    block the thread that is logging.
+
+    The log context is added to each record by a context filter on this handler,
+    before it is put on the queue, since it's only available on the thread (or
+    task) that logged it.
+    """
+
+    def __init__(self, handler):
+        super().__init__(_SimpleQueue())
+        self.handler = handler
+        handler.defer_flush = True
+        self.listener = None
+        self.start()
+
+    def start(self):
+        self.listener = _FlushingQueueListener(
+            self.queue, self.handler, respect_handler_level=True
+        )
+        self.listener.start()
+
+    def stop(self):
+        """Stop the listener thread after it has emitted all queued records."""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            self.handler.flush_deferred()
+
+    def restart_after_fork(self):
+        # The listener thread doesn't survive fork(), and the queue might have
+        # been locked by another thread when it happened, so start over.
+        self.queue = _SimpleQueue()
+        self.start()
+
+    def prepare(self, record):
+        # Format the message now, in case the arguments change before it's emitted,
+        # on a copy, since other handlers may get the same record.
+        # (Unlike QueueHandler.prepare(), this leaves exc_info etc. to the handler.)
+        record = copy.copy(record)
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def _stop_queue_handlers():
+    for handler in logging.root.handlers:
+        if isinstance(handler, _LogContextQueueHandler):
+            handler.stop()
+
+
+def _restart_queue_handlers_after_fork():
+    for handler in logging.root.handlers:
+        if isinstance(handler, _LogContextQueueHandler):
+            handler.restart_after_fork()
+
+
+# Make sure queued records are written before exiting.
+atexit.register(_stop_queue_handlers)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_queue_handlers_after_fork)
 
 
 def _remove_existing_stream_handlers():
@@ -293,58 +657,118 @@ def _remove_existing_stream_handlers():
     Remove existing root logger handlers so that we can safely re-run log setup.
     """
     root_logger = logging.root
-    for handler in root_logger.handlers:
-        if isinstance(handler, _LogContextHandler):
-            root_logger.removeHandler(handler)
+    handlers = root_logger.handlers
+    # Rebinding the list is atomic, so this doesn't need the logging lock.
+    root_logger.handlers = [
+        h
+        for h in handlers
+        if not isinstance(h, (_LogContextHandler, _LogContextQueueHandler))
+    ]
 
+    # Stop queue handlers after they're removed, so nothing is queued after that.
+    for handler in handlers:
+        if isinstance(handler, _LogContextQueueHandler):
+            handler.stop()
 
-def _setup_structured_logging(min_level, stream):
-    formatter = StackdriverJsonFormatter(timestamp=True, json_default=json_default)
 
-    stream_handler = _StructuredLogContextHandler(stream)
-    stream_handler.setLevel(min_level)
-    stream_handler.setFormatter(formatter)
+def _install_root_handler(handler, context_filter, min_level, queued):
+    handler.setLevel(min_level)
+    loggers = [handler]
+
+    if queued:
+        handler = _LogContextQueueHandler(handler)
+        handler.setLevel(min_level)
+        loggers.append(handler)
+
+    handler.addFilter(context_filter)
 
     root_logger = logging.getLogger()
     _remove_existing_stream_handlers()
-    root_logger.addHandler(stream_handler)
+    root_logger.addHandler(handler)
     root_logger.setLevel(min_level)
 
+    return [*loggers, root_logger]
+
+
+def _setup_structured_logging(min_level, stream, queued):
+    formatter = StackdriverJsonFormatter(timestamp=True, json_default=json_default)
+
+    stream_handler = _LogContextHandler(stream)
+    stream_handler.setFormatter(formatter)
+    loggers = _install_root_handler(
+        stream_handler, _StructuredContextFilter(), min_level, queued
+    )
+
     sys.excepthook = _global_exception_handler
 
-    return [stream_handler, root_logger]
+    return loggers
+
+
+class _PlaintextFormatter(Formatter):
+    """
+    A Formatter that only formats the date and time part of asctime once per
+    second, since time.strftime() is the slowest part of formatting a record.
+    """
+
+    _cached_time = (None, None)
 
+    def formatTime(self, record, datefmt=None):
+        if datefmt is not None:
+            return super().formatTime(record, datefmt)
 
-def _setup_plaintext_logging(min_level, stream):
-    formatter = Formatter(
+        second = int(record.created)
+        # (A single tuple, so other threads never see a mismatched second and string.)
+        (cached_second, formatted) = self._cached_time
+        if cached_second != second:
+            formatted = strftime(
+                self.default_time_format, self.converter(record.created)
+            )
+            self._cached_time = (second, formatted)
+        return self.default_msec_format % (formatted, record.msecs)
+
+
+def _setup_plaintext_logging(min_level, stream, queued):
+    formatter = _PlaintextFormatter(
         fmt="%(asctime)s %(levelname)-7s "
         "%(filename)s:%(lineno)s:%(funcName)s, "
         "process=%(process)d, thread=%(thread)d: %(message)s%(context)s"
     )
 
-    stream_handler = _PlaintextLogContextHandler(stream)
-    stream_handler.setLevel(min_level)
+    stream_handler = _LogContextHandler(stream)
     stream_handler.setFormatter(formatter)
 
-    root_logger = logging.getLogger()
-    _remove_existing_stream_handlers()
-    root_logger.addHandler(stream_handler)
-    root_logger.setLevel(min_level)
-
-    return [stream_handler, root_logger]
+    return _install_root_handler(
+        stream_handler, _PlaintextContextFilter(), min_level, queued
+    )
 
 
 def _override_log_handlers():
-    loggers = logging.root.manager.loggerDict.values()
-    for logger in [logging.root, *loggers]:
-        if hasattr(logger, "handlers"):
-            for handler in logger.handlers[:]:
-                if not isinstance(handler, _LogContextHandler):
-                    logger.removeHandler(handler)
+    # (Snapshot the loggers, since other threads may create loggers meanwhile.)
+    loggers = [logging.root, *logging.root.manager.loggerDict.values()]
+    for logger in loggers:
+        if isinstance(logger, logging.PlaceHolder):
+            continue
+        if logger.handlers:
+            # Rebinding the list is atomic, so this doesn't need the logging lock.
+            logger.handlers = [
+                h
+                for h in logger.handlers
+                if isinstance(h, (_LogContextHandler, _LogContextQueueHandler))
+            ]
         logger.propagate = True
 
 
-def setup_logging(min_level=logging.INFO, plaintext=None, stream=None, override=None):
+_FALSY_ENV_VALUES = frozenset({"", "0", "false", "f"})
+_TRUTHY_ENV_VALUES = frozenset({"1", "true", "t"})
+
+
+# Whether setup_logging() has disabled logging.logMultiprocessing.
+_log_multiprocessing_disabled = False
+
+
+def setup_logging(
+    min_level=logging.INFO, plaintext=None, stream=None, override=None, queued=None
+):
     """
     Set up logging with sensible defaults. Enables output of structured
     log contexts using the LogContext context manager.
@@ -362,24 +786,28 @@ def setup_logging(min_level=logging.INFO, plaintext=None, stream=None, override=
         on the root logger and enable propagation for every logger. To make
         sure that we receive all the log entries in the format we want with '
         contexts. Can be enabled/disabled with NIVACLOUD_OVERRIDE_LOGGERS
-        environment variable.
+        environment variable. (This also disables logging.logMultiprocessing
+        until logging is set up without override, since processName isn't
+        logged.)
+    :param queued: If true, format and write log entries on a separate thread
+        via a queue, so that logging doesn't block on output. Log entries may
+        then appear a little after the logging call returns. If None, enable
+        if the NIVACLOUD_QUEUED_LOGS environment variable is set.
     """
 
     if plaintext is None:
-        plaintext = os.getenv("NIVACLOUD_PLAINTEXT_LOGS", "").lower() not in (
-            "",
-            "0",
-            "false",
-            "f",
+        plaintext = (
+            os.getenv("NIVACLOUD_PLAINTEXT_LOGS", "").lower() not in _FALSY_ENV_VALUES
         )
 
     if override is None:
-        override = os.getenv("NIVACLOUD_OVERRIDE_LOGGERS", "1").lower() in (
-            "1",
-            "true",
-            "t",
+        override = (
+            os.getenv("NIVACLOUD_OVERRIDE_LOGGERS", "1").lower() in _TRUTHY_ENV_VALUES
         )
 
+    if queued is None:
+        queued = os.getenv("NIVACLOUD_QUEUED_LOGS", "").lower() not in _FALSY_ENV_VALUES
+
     LogContext.reset_defaults()
     commit_id = os.getenv("GIT_COMMIT_ID")
     if commit_id and commit_id != "unknown":
@@ -395,11 +823,21 @@ def setup_logging(min_level=logging.INFO, plaintext=None, stream=None, override=
         stream = sys.stderr if plaintext else sys.stdout
 
     if plaintext:
-        loggers = _setup_plaintext_logging(min_level, stream)
+        loggers = _setup_plaintext_logging(min_level, stream, queued)
     else:
-        loggers = _setup_structured_logging(min_level, stream)
+        loggers = _setup_structured_logging(min_level, stream, queued)
 
+    global _log_multiprocessing_disabled
     if override:
         _override_log_handlers()
+        # Our formatters don't output processName, so don't look it up for every
+        # LogRecord. (Unlike taskName, which JSON log entries include on 3.12+.)
+        if logging.logMultiprocessing:
+            logging.logMultiprocessing = False
+            _log_multiprocessing_disabled = True
+    elif _log_multiprocessing_disabled:
+        # Other handlers may need it again.
+        logging.logMultiprocessing = True
+        _log_multiprocessing_disabled = False
 
     _loglevel_signal_handler(loggers)
@@ -19,13 +19,12 @@ class TracingAdapter(HTTPAdapter):
 
     def add_headers(self, request, **kwargs):
         super().add_headers(request, **kwargs)
-        incoming_trace_id = LogContext.getcontext("trace_id")
-        if incoming_trace_id:
-            request.headers["Trace-Id"] = incoming_trace_id
-
-        incoming_user_id = LogContext.getcontext("user_id")
-        if incoming_user_id:
-            request.headers["User-Id"] = incoming_user_id
-        request.headers["Span-Id"] = (
-            LogContext.getcontext("span_id") or generate_trace_id()
-        )
+        context = LogContext.getcontext()
+        headers = request.headers
+        trace_id = context.get("trace_id")
+        if trace_id:
+            headers["Trace-Id"] = trace_id
+        user_id = context.get("user_id")
+        if user_id:
+            headers["User-Id"] = user_id
+        headers["Span-Id"] = context.get("span_id") or generate_trace_id()
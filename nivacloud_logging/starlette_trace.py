@@ -1,35 +1,65 @@
 import logging
 
 from nivacloud_logging.log_utils import generate_trace_id, LogContext, log_exceptions
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
 from starlette.requests import Request
-from starlette.responses import Response
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+# Headers we pick up from requests. (ASGI header names are always lowercase.)
+_HEADER_KEYS = {
+    b"trace-id": "trace_id",
+    b"span-id": "span_id",
+    b"user-id": "user_id",
+    b"user-agent": "user_agent",
+}
 
 
 def log_request(request: Request):
+    _log_request(request, request.headers.get("user-agent"))
+
+
+def _log_request(request: Request, user_agent):
+    url = request.url
     logging.info(
-        f"{request.method} {request.url.path} ",
-        extra={
-            "query_params": request.url.query,
-            "user_agent": request.headers.get("user-agent"),
-        },
+        f"{request.method} {url.path} ",
+        extra={"query_params": url.query, "user_agent": user_agent},
     )
 
 
-class StarletteTracingMiddleware(BaseHTTPMiddleware):
-    async def dispatch(
-        self, request: Request, call_next: RequestResponseEndpoint
-    ) -> Response:
-        contextvars = {
-            "trace_id": request.headers.get("trace-id") or generate_trace_id(),
-            "user_id": request.headers.get("user-id"),
-            "span_id": request.headers.get("span-id") or generate_trace_id(),
-        }
+class StarletteTracingMiddleware:
+    """
+    ASGI middleware that looks for Trace-Id, User-Id and Span-Id headers in every
+    HTTP request and adds them to LogContext for that request, generating trace
+    and span IDs if missing. Also logs every request and any exceptions.
+
+    (This is a plain ASGI middleware rather than a BaseHTTPMiddleware, which runs
+    every request in a separate task.)
+
+    Usage:
+      app = Starlette()
+      app.add_middleware(StarletteTracingMiddleware)
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Scan the raw headers once instead of looking up each header separately.
+        headers = {}
+        for (name, value) in scope["headers"]:
+            key = _HEADER_KEYS.get(name)
+            if key is not None and key not in headers:
+                headers[key] = value.decode("latin-1")
 
-        contextvars_with_values = {
-            k: v for k, v in contextvars.items() if v is not None
-        }
+        user_agent = headers.pop("user_agent", None)
+        if not headers.get("trace_id"):
+            headers["trace_id"] = generate_trace_id()
+        if not headers.get("span_id"):
+            headers["span_id"] = generate_trace_id()
 
-        with LogContext(**contextvars_with_values), log_exceptions():
-            log_request(request)
-            return await call_next(request)
+        with LogContext(**headers), log_exceptions():
+            _log_request(Request(scope), user_agent)
+            await self.app(scope, receive, send)
@@ -7,8 +7,9 @@ OPTIONAL_REQUIREMENTS = {
     'requests': ["requests>=2.22.0"],
     'flask': ["Flask>=1.1.0"],
     'aiohttp': ["aiohttp>=3.0.0"],
-    'starlette': ["starlette>=0.7.2"],
+    'starlette': ["starlette>=0.13.0"],
     'gunicorn': ["gunicorn>=19.0.0"],
+    'orjson': ["orjson>=3.0.0"],
 }
 
 # ...but we always need them for testing:
@@ -57,6 +58,8 @@ setup(
     ],
     install_requires=[
         "python-json-logger>=0.1.11,<0.2",
+        # Backport of contextvars for Python 3.6
+        "contextvars>=2.4; python_version < '3.7'",
     ],
     setup_requires=[
         "pytest-runner",
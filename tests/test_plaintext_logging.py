@@ -13,7 +13,11 @@ from uuid import UUID
 
 import pytest
 
-from nivacloud_logging.log_utils import setup_logging, LogContext, auto_context, log_exceptions
+from nivacloud_logging.log_utils import setup_logging, LogContext, auto_context, bind_log_context, log_exceptions, \
+    _PlaintextFormatter
+
+_TIMESTAMP_RE = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}')
+_THREAD_ID_RE = re.compile(r'thread=(\d+)')
 
 
 def _readout_log(capsys):
@@ -31,7 +35,18 @@ def test_should_log_something(capsys):
     assert "INFO" in log
     assert "process=" in log
     assert "thread=" in log
-    assert re.search(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}', log), "Missing or malformed timestamp"
+    assert _TIMESTAMP_RE.search(log), "Missing or malformed timestamp"
+
+
+def test_should_format_timestamps_like_the_default_formatter():
+    formatter = _PlaintextFormatter("%(asctime)s %(message)s")
+    default_formatter = logging.Formatter("%(asctime)s %(message)s")
+
+    for created in [1577836799.999, 1577836800.0, 1577836800.5, 1577836801.25, 1577836800.75]:
+        record = logging.makeLogRecord({"msg": "Tick"})
+        record.created = created
+        record.msecs = (created - int(created)) * 1000
+        assert formatter.format(record) == default_formatter.format(record)
 
 
 def test_should_log_context(capsys):
@@ -175,15 +190,15 @@ def test_should_handle_multiple_threads_with_contexts(capsys):
     t.join()
 
     (log, _) = capsys.readouterr()
-    [child, parent] = log.split('\n')[0:2]
+    [child, parent] = log.split('\n', 2)[0:2]
 
     assert 'tid="child"' in child
     assert "Hi from child!" in child
     assert 'tid="parent"' in parent
     assert "Hi from parent!" in parent
 
-    child_tid = re.search(r'thread=(\d+)', child).group(1)
-    parent_tid = re.search(r'thread=(\d+)', parent).group(1)
+    child_tid = _THREAD_ID_RE.search(child).group(1)
+    parent_tid = _THREAD_ID_RE.search(parent).group(1)
     assert child_tid != parent_tid
 
     assert "INFO" in child
@@ -219,6 +234,22 @@ def test_extra_parameters_should_override(capsys):
     assert 'foo="quux"' in log
 
 
+def test_should_log_via_queue(capsys):
+    setup_logging(plaintext=True, stream=sys.stdout, queued=True)
+
+    with LogContext(trace_id=123):
+        logging.info("Queued with %s", "context", extra={'xyzzy': 'qwerty'})
+
+    # Setting up again stops the listener after it has written everything queued.
+    setup_logging(plaintext=True, stream=sys.stdout)
+
+    log = _readout_log(capsys)
+
+    assert "--- Logging error ---" not in log
+    assert "Queued with context" in log
+    assert '[trace_id=123, xyzzy="qwerty"]' in log
+
+
 def test_should_work_with_nonroot_logger(capsys):
     setup_logging(stream=sys.stdout, plaintext=True)
 
@@ -360,6 +391,81 @@ def test_should_handle_complex_context_data(capsys):
     assert '"nan": NaN' in log
 
 
+def test_should_encode_context_values_once_per_context(capsys):
+    setup_logging(plaintext=True, stream=sys.stdout)
+
+    class Counted:
+        encode_count = 0
+
+        def __str__(self):
+            Counted.encode_count += 1
+            return "counted"
+
+    with LogContext(counted=Counted()):
+        logging.info("First")
+        logging.info("Second")
+        with LogContext(trace_id=123):
+            logging.info("Nested")
+
+    log = _readout_log(capsys)
+
+    assert "--- Logging error ---" not in log
+    assert log.count('counted="counted"') == 3
+    assert "trace_id=123" in log
+    assert Counted.encode_count == 1
+
+
+def test_should_encode_context_values_separately_on_other_threads(capsys):
+    setup_logging(plaintext=True, stream=sys.stdout)
+
+    # A thread logging in a copy of a context must not touch encoded values that
+    # this thread uses when entering a nested context at the same time. (Switching
+    # threads often makes it likely that they actually overlap.)
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for i in range(100):
+            with LogContext(**{f"key{j}": j for j in range(200)}):
+                thread = threading.Thread(target=bind_log_context(logging.info), args=("From thread",))
+                thread.start()
+                try:
+                    while thread.is_alive():
+                        with LogContext(nested=i):
+                            pass
+                finally:
+                    thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+    log = _readout_log(capsys)
+
+    assert "--- Logging error ---" not in log
+    assert log.count("From thread") == 100
+    assert log.count("key199=199") == 100
+
+
+def test_should_not_encode_context_values_unless_logged(capsys):
+    setup_logging(min_level=logging.WARNING, plaintext=True, stream=sys.stdout)
+
+    class Counted:
+        encode_count = 0
+
+        def __str__(self):
+            Counted.encode_count += 1
+            return "counted"
+
+    with LogContext(counted=Counted()):
+        logging.info("Not logged")
+        assert Counted.encode_count == 0
+        logging.warning("Logged")
+
+    log = _readout_log(capsys)
+
+    assert 'counted="counted"' in log
+    assert "Not logged" not in log
+    assert Counted.encode_count == 1
+
+
 def test_sigusr1_should_set_info_logging(capsys):
     setup_logging(min_level=logging.ERROR, plaintext=True, stream=sys.stdout)
     logging.info("Not logged")
@@ -437,7 +543,7 @@ def test_should_add_commit_it_from_environment_to_all_threads(capsys, monkeypatc
     t.join()
 
     (log, _) = capsys.readouterr()
-    [child, parent] = log.split('\n')[0:2]
+    [child, parent] = log.split('\n', 2)[0:2]
 
     assert 'tid="child"' in child
     assert "Hi from child!" in child
@@ -471,7 +577,7 @@ def test_local_should_override_global_context(capsys):
         logging.info('Local')
 
     (log, _) = capsys.readouterr()
-    [global_, local] = log.split('\n')[0:2]
+    [global_, local] = log.split('\n', 2)[0:2]
 
     assert "--- Logging error ---" not in log
 
@@ -481,6 +587,51 @@ def test_local_should_override_global_context(capsys):
     assert 'attire="grilldress"' in local
 
 
+def test_overridden_global_context_should_keep_its_position(capsys):
+    setup_logging(plaintext=True, stream=sys.stdout)
+    LogContext.set_default("attire", "barbecue suit")
+    try:
+        with LogContext(drink="beer", attire="grilldress"):
+            logging.info('Local')
+            assert list(LogContext.iter_context()) == list(LogContext.getcontext().items())
+    finally:
+        LogContext.reset_defaults()
+
+    log = _readout_log(capsys)
+
+    assert "--- Logging error ---" not in log
+    assert log.index('attire="grilldress"') < log.index('drink="beer"')
+
+
+def test_should_not_keep_stale_encoded_global_context(capsys):
+    setup_logging(plaintext=True, stream=sys.stdout)
+
+    class ChangesDefault:
+        changed = False
+
+        def __str__(self):
+            # Like another thread calling set_default() while this one encodes.
+            if not ChangesDefault.changed:
+                ChangesDefault.changed = True
+                LogContext.set_default("attire", "grilldress")
+            return "changes default"
+
+    LogContext.set_default("attire", "barbecue suit")
+    LogContext.set_default("changer", ChangesDefault())
+    try:
+        logging.info('First')
+        logging.info('Second')
+    finally:
+        LogContext.reset_defaults()
+
+    log = _readout_log(capsys)
+    [first, second] = log.split('\n', 2)[0:2]
+
+    assert "--- Logging error ---" not in log
+    assert 'attire="barbecue suit"' in first
+    assert 'attire="grilldress"' in second
+
+
 def test_log_exceptions_context_should_log_exceptions(capsys):
     setup_logging(plaintext=True, stream=sys.stdout)
 
@@ -489,7 +640,7 @@ def test_log_exceptions_context_should_log_exceptions(capsys):
         raise Exception("In context manager")
 
     (log, _) = capsys.readouterr()
-    [in_ctx, in_ctx_man] = log.split('\n')[0:2]
+    [in_ctx, in_ctx_man] = log.split('\n', 2)[0:2]
 
     assert "--- Logging error ---" not in log
 
@@ -507,7 +658,7 @@ def test_log_exceptions_suppress(capsys):
         raise Exception("In context manager")
 
     (log, _) = capsys.readouterr()
-    [in_ctx, in_ctx_man] = log.split('\n')[0:2]
+    [in_ctx, in_ctx_man] = log.split('\n', 2)[0:2]
 
     assert "--- Logging error ---" not in log
 
@@ -1,18 +1,26 @@
 import asyncio
 import contextlib
+import io
 import json
 import logging
 import math
 import os
 import signal
+import sys
 import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import datetime, timezone
+from enum import Enum
 from uuid import UUID
 
 import pytest
+from pythonjsonlogger import jsonlogger
 
-from nivacloud_logging.log_utils import setup_logging, LogContext, auto_context, log_exceptions
+from nivacloud_logging import json_formatter
+from nivacloud_logging.log_utils import setup_logging, LogContext, auto_context, bind_log_context, log_context, \
+    log_exceptions
 
 
 def _readout_json(capsys):
@@ -81,6 +89,49 @@ def test_should_not_log_below_log_level(capsys):
     assert log_json["timestamp"] is not None
 
 
+class _ExpensiveToFormat:
+    def __str__(self):
+        raise AssertionError("Formatted an argument for a record that isn't logged")
+
+
+@pytest.mark.parametrize("queued", [False, True])
+def test_should_not_format_arguments_below_log_level(capsys, queued):
+    setup_logging(min_level=logging.WARNING, queued=queued)
+
+    with LogContext(trace_id=123):
+        logging.info("this should not be logged: %s", _ExpensiveToFormat())
+        logging.warning("warning should be %s", "logged")
+
+    setup_logging()
+
+    log_json = _readout_json(capsys)
+    assert log_json["message"] == "warning should be logged"
+
+
+def test_should_not_add_context_below_log_level(capsys, monkeypatch):
+    setup_logging(min_level=logging.WARNING)
+    # Enabled on the logger itself, but below the level of the handler.
+    logger = logging.getLogger("verbose")
+    logger.setLevel(logging.DEBUG)
+
+    context_lookups = []
+    monkeypatch.setattr(LogContext, "iter_context", lambda: context_lookups.append(1) or ())
+
+    try:
+        with LogContext(trace_id=123):
+            logger.debug("this should not be logged")
+            logger.info("this should not be logged either")
+        assert context_lookups == []
+
+        logger.warning("warning should be logged")
+        assert context_lookups == [1]
+    finally:
+        logger.setLevel(logging.NOTSET)
+
+    log_json = _readout_json(capsys)
+    assert log_json["message"] == "warning should be logged"
+
+
 def test_should_include_context(capsys):
     setup_logging()
     with LogContext(trace_id=123):
@@ -95,6 +146,17 @@ def test_should_include_context(capsys):
     assert log_json["timestamp"] is not None
 
 
+def test_should_handle_context_key_named_cls(capsys):
+    setup_logging()
+    with LogContext(cls="Foo"):
+        logging.info("Something classy happened!")
+
+    log_json = _readout_json(capsys)
+
+    assert log_json["message"] == "Something classy happened!"
+    assert log_json["cls"] == "Foo"
+
+
 def test_should_handle_nested_context(capsys):
     setup_logging()
     with LogContext(trace_id=123, foo="bar"):
@@ -111,6 +173,23 @@ def test_should_handle_nested_context(capsys):
     assert log_json["timestamp"] is not None
 
 
+def test_should_exit_context_entered_in_another_context(capsys):
+    setup_logging()
+    with LogContext(trace_id=123):
+        # Like an async generator that enters a context in one task and is
+        # resumed in another.
+        context = LogContext(foo="bar")
+        copy_context().run(context.__enter__)
+        context.__exit__(None, None, None)
+        logging.info("After exiting")
+
+    log_json = _readout_json(capsys)
+
+    assert log_json["trace_id"] == 123
+    assert "foo" not in log_json
+    assert LogContext.getcontext() == {}
+
+
 def test_should_handle_extra_parameters(capsys):
     setup_logging()
 
@@ -167,6 +246,50 @@ async def test_should_handle_async_context(capsys):
     assert log_json["timestamp"] is not None
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("queued", [False, True])
+async def test_should_handle_concurrent_async_contexts(capsys, queued):
+    setup_logging(queued=queued)
+
+    async def worker(name, delay):
+        async with LogContext(task=name):
+            await asyncio.sleep(delay)
+            logging.info(f"Hi from {name}!")
+
+    await asyncio.gather(worker("slow", 0.02), worker("fast", 0.01))
+    # (Stops the queue listener, if any, after it has written everything.)
+    setup_logging()
+
+    (out, _) = capsys.readouterr()
+    [fast, slow] = [json.loads(s) for s in out.split("\n") if s]
+
+    assert fast["message"] == "Hi from fast!"
+    assert fast["task"] == "fast"
+    assert slow["message"] == "Hi from slow!"
+    assert slow["task"] == "slow"
+
+
+@pytest.mark.asyncio
+async def test_tasks_should_inherit_but_not_leak_context(capsys):
+    setup_logging()
+
+    async def child():
+        async with LogContext(child="yes"):
+            logging.info("In child")
+
+    async with LogContext(trace_id=123):
+        await asyncio.ensure_future(child())
+        logging.info("In parent")
+
+    (out, _) = capsys.readouterr()
+    [in_child, in_parent] = [json.loads(s) for s in out.split("\n") if s]
+
+    assert in_child["trace_id"] == 123
+    assert in_child["child"] == "yes"
+    assert in_parent["trace_id"] == 123
+    assert "child" not in in_parent
+
+
 def test_should_handle_multiple_threads_with_contexts(capsys):
     # This test runs a child thread with a log context while
     # (hopefully, depending on timing)
@@ -205,6 +328,108 @@ def test_should_handle_multiple_threads_with_contexts(capsys):
     assert parent['timestamp'] is not None
 
 
+def test_should_pass_context_to_thread_pool_with_bind_log_context(capsys):
+    setup_logging()
+
+    def worker(n):
+        logging.info("Hi from worker %d", n)
+
+    with ThreadPoolExecutor(max_workers=2) as executor, LogContext(trace_id=123):
+        list(executor.map(bind_log_context(worker), range(4)))
+        executor.submit(worker, 4).result()
+
+    (out, _) = capsys.readouterr()
+    records = sorted((json.loads(s) for s in out.split("\n") if s), key=lambda r: r["message"])
+
+    assert [r["message"] for r in records] == [f"Hi from worker {n}" for n in range(5)]
+    assert [r.get("trace_id") for r in records] == [123] * 4 + [None]
+
+
+def test_should_log_via_queue(capsys):
+    setup_logging(queued=True)
+
+    with LogContext(trace_id=123):
+        logging.info("Queued with %s", "context")
+    logging.info("Queued without context")
+
+    # Setting up again stops the listener after it has written everything queued.
+    setup_logging()
+
+    (out, _) = capsys.readouterr()
+    [with_ctx, without_ctx] = [json.loads(s) for s in out.split("\n") if s]
+
+    assert with_ctx["message"] == "Queued with context"
+    assert with_ctx["trace_id"] == 123
+    assert with_ctx["thread"] == threading.get_ident()
+    assert without_ctx["message"] == "Queued without context"
+    assert "trace_id" not in without_ctx
+
+
+class _RecordCollectingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def test_queued_logging_should_not_change_records_for_other_handlers(capsys):
+    setup_logging(queued=True)
+    other_handler = _RecordCollectingHandler()
+    logging.getLogger().addHandler(other_handler)
+    try:
+        logging.info("Queued with %s", "arguments")
+    finally:
+        logging.getLogger().removeHandler(other_handler)
+    setup_logging()
+
+    (out, _) = capsys.readouterr()
+    assert json.loads(out)["message"] == "Queued with arguments"
+    [record] = other_handler.records
+    assert record.msg == "Queued with %s"
+    assert record.args == ("arguments",)
+
+
+def test_should_handle_multiple_threads_with_contexts_via_queue(capsys):
+    setup_logging(queued=True)
+
+    def worker(n):
+        with LogContext(worker=n):
+            for i in range(10):
+                logging.info("Hi from worker %d", n)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    setup_logging()
+
+    (out, _) = capsys.readouterr()
+    records = [json.loads(s) for s in out.split("\n") if s]
+
+    assert len(records) == 40
+    for record in records:
+        assert record["message"] == f"Hi from worker {record['worker']}"
+    assert {record["worker"] for record in records} == {0, 1, 2, 3}
+
+
+def test_queued_logs_should_be_flushed_when_stopped():
+    raw = io.BytesIO()
+    stream = io.TextIOWrapper(raw, encoding="utf-8")
+    setup_logging(queued=True, stream=stream)
+
+    for i in range(10):
+        logging.info("Buffered %d", i)
+
+    setup_logging()
+
+    lines = raw.getvalue().decode().splitlines()
+    assert [json.loads(s)["message"] for s in lines] == [f"Buffered {i}" for i in range(10)]
+
+
 def test_should_work_with_nonroot_logger(capsys):
     setup_logging()
     logger = logging.getLogger("nonroot")
@@ -240,6 +465,39 @@ def test_should_override_propagation(capsys):
     assert log_json['message'] == 'Hei'
 
 
+def test_multiple_setup_calls_should_keep_other_handlers(capsys):
+    other_handler = logging.NullHandler()
+    logging.root.addHandler(other_handler)
+    try:
+        setup_logging(override=False)
+        handler_count = len(logging.root.handlers)
+        setup_logging(override=False, queued=True)
+        setup_logging(override=False)
+
+        logging.info('Hei')
+
+        log_json = _readout_json(capsys)
+        assert log_json['message'] == 'Hei'
+        assert other_handler in logging.root.handlers
+        assert len(logging.root.handlers) == handler_count
+    finally:
+        logging.root.removeHandler(other_handler)
+
+
+def test_override_should_skip_unused_record_attributes(monkeypatch):
+    # (So that it is restored after the test.)
+    monkeypatch.setattr(logging, "logMultiprocessing", True)
+    setup_logging()
+
+    record = logging.makeLogRecord({})
+
+    assert record.processName is None
+
+    setup_logging(override=False)
+
+    assert logging.logMultiprocessing
+
+
 def test_should_not_log_on_non_override(capsys):
     logger = logging.getLogger('foo')
     logger.propagate = False
@@ -262,6 +520,25 @@ def test_should_handle_multiple_setup_calls(capsys):
     assert log_json['message'] == 'Hei'
 
 
+def test_log_context_decorator_should_add_context(capsys):
+    @log_context(foo="bar")
+    def xyzzy(x):
+        logging.info("Decorated")
+        return x + 1
+
+    setup_logging()
+    assert xyzzy(41) == 42
+    logging.info("Undecorated")
+
+    (out, _) = capsys.readouterr()
+    [decorated, undecorated] = [json.loads(s) for s in out.split("\n") if s]
+
+    assert decorated["message"] == "Decorated"
+    assert decorated["foo"] == "bar"
+    assert undecorated["message"] == "Undecorated"
+    assert "foo" not in undecorated
+
+
 def test_auto_context_should_only_add_requested_context(capsys):
     # noinspection PyUnusedLocal
     @auto_context("host", "user")
@@ -293,6 +570,44 @@ def test_auto_context_should_log_all_parameters_by_default(capsys):
     assert log_json["servers"] == ["1.1.1.1", "8.8.8.8"]
 
 
+def test_auto_context_should_handle_keyword_and_default_arguments(capsys):
+    # noinspection PyUnusedLocal
+    @auto_context()
+    def connect(host, port=21, *, timeout=10, retries=3):
+        logging.info("Connecting...")
+
+    setup_logging()
+    connect("ftp.example.com", timeout=5)
+
+    log_json = _readout_json(capsys)
+
+    assert log_json["host"] == "ftp.example.com"
+    assert log_json["port"] == 21
+    assert log_json["timeout"] == 5
+    assert log_json["retries"] == 3
+
+
+def test_auto_context_should_handle_varargs_with_keyword_arguments(capsys):
+    # noinspection PyUnusedLocal
+    @auto_context()
+    def lookup(host, *servers, timeout=10):
+        logging.info("Doing lookup...")
+
+    setup_logging()
+    lookup("ftp.example.com", "1.1.1.1", "8.8.8.8", timeout=5)
+    lookup("example.com")
+
+    (out, _) = capsys.readouterr()
+    [with_servers, without_servers] = [json.loads(s) for s in out.split("\n") if s]
+
+    assert with_servers["host"] == "ftp.example.com"
+    assert with_servers["servers"] == ["1.1.1.1", "8.8.8.8"]
+    assert with_servers["timeout"] == 5
+    assert without_servers["host"] == "example.com"
+    assert without_servers["servers"] == []
+    assert without_servers["timeout"] == 10
+
+
 def test_auto_context_on_instance_methods(capsys):
     class MyClass:
         # noinspection PyUnusedLocal
@@ -333,9 +648,141 @@ def test_should_handle_complex_context_data(capsys):
     assert thing['my_id'] == '7118ad7e-6e26-483a-a120-7ec176331354'
     assert thing['time'] == '2019-12-24T12:34:56'
     assert ["foo", {"complex": {"real": 12.0, "imag": 45.0}}, 1, 1.2, -4, 1.4e-10] == thing["tupled"]
+    # (Serialized with json even if orjson is installed, because of the UUID, so
+    # NaN isn't output as null.)
     assert math.isnan(thing['nan'])
 
 
+class _Colour(Enum):
+    RED = 1
+
+
+class _DateOnlyJsonEncoder(jsonlogger.JsonEncoder):
+    def format_datetime_obj(self, obj):
+        return obj.date().isoformat()
+
+
+def _format_with_and_without_orjson(monkeypatch, formatter, thing=None):
+    record = logging.LogRecord(
+        "test", logging.INFO, __file__, 42, "Hello %s", ("world",), None,
+    )
+    if thing is None:
+        thing = {"list": [1, 2.5, None, True], "time": datetime(2019, 12, 24)}
+    record.thing = thing
+    record.place = "Målestasjon ø \U0001f30a\u2028\x1f\x7f"
+
+    with_orjson = formatter.format(record)
+    with monkeypatch.context() as m:
+        m.setattr(json_formatter, "orjson", None)
+        without_orjson = formatter.format(record)
+    return (with_orjson, without_orjson)
+
+
+def _without_spaces(s, ensure_ascii=True):
+    # (orjson doesn't output spaces after separators.)
+    return json.dumps(json.loads(s), separators=(",", ":"), ensure_ascii=ensure_ascii)
+
+
+@pytest.mark.skipif(json_formatter.orjson is None, reason="orjson not installed")
+@pytest.mark.parametrize("json_default", [None, lambda o: f"default {o}"])
+def test_orjson_and_json_output_should_be_identical(monkeypatch, json_default):
+    formatter = json_formatter.StackdriverJsonFormatter(timestamp=False, json_default=json_default)
+
+    (with_orjson, without_orjson) = _format_with_and_without_orjson(monkeypatch, formatter)
+
+    assert with_orjson == _without_spaces(without_orjson)
+    # (Escaped like json.dumps() does by default, so it can be written to any stream.)
+    with_orjson.encode("ascii")
+    log_json = json.loads(with_orjson)
+    assert log_json["place"] == "Målestasjon ø \U0001f30a\u2028\x1f\x7f"
+    if json_default is None:
+        assert log_json["thing"]["time"] == "2019-12-24T00:00:00"
+    else:
+        assert log_json["thing"]["time"] == "default 2019-12-24 00:00:00"
+
+
+@pytest.mark.skipif(json_formatter.orjson is None, reason="orjson not installed")
+def test_orjson_and_json_output_should_be_identical_without_ensure_ascii(monkeypatch):
+    formatter = json_formatter.StackdriverJsonFormatter(timestamp=False, json_ensure_ascii=False)
+
+    (with_orjson, without_orjson) = _format_with_and_without_orjson(monkeypatch, formatter)
+
+    assert with_orjson == _without_spaces(without_orjson, ensure_ascii=False)
+    assert "Målestasjon ø" in with_orjson
+
+
+@pytest.mark.skipif(json_formatter.orjson is None, reason="orjson not installed")
+def test_orjson_and_json_output_should_have_the_same_float_values(monkeypatch):
+    formatter = json_formatter.StackdriverJsonFormatter(timestamp=False)
+    thing = {"big": 1e16, "small": 1e-05, "short": 0.1, "long": 1 / 3}
+
+    (with_orjson, without_orjson) = _format_with_and_without_orjson(monkeypatch, formatter, thing)
+
+    # orjson formats some floats differently, but they parse to the same values.
+    assert '"big":1e16,"small":0.00001,' in with_orjson
+    assert '"big": 1e+16, "small": 1e-05,' in without_orjson
+    assert json.loads(with_orjson) == json.loads(without_orjson)
+    assert json.loads(with_orjson)["thing"] == thing
+
+
+@pytest.mark.parametrize("thing", [
+    {"colour": _Colour.RED, "id": UUID('7118ad7e-6e26-483a-a120-7ec176331354')},
+    {"nested": [{"colour": _Colour.RED}], "id": "7118ad7e-6e26-483a-a120-7ec176331354"},
+    {"default": datetime(2019, 12, 24), "id": "7118ad7e-6e26-483a-a120-7ec176331354"},
+])
+def test_should_serialize_enums_and_uuids_like_json_does(monkeypatch, thing):
+    def json_default(o):
+        if isinstance(o, datetime):
+            return {"colour": _Colour.RED}
+        return f"<{o}>"
+
+    formatter = json_formatter.StackdriverJsonFormatter(timestamp=False, json_default=json_default)
+
+    (with_orjson, without_orjson) = _format_with_and_without_orjson(monkeypatch, formatter, thing)
+
+    assert with_orjson == without_orjson
+    assert "<_Colour.RED>" in with_orjson
+    assert "7118ad7e-6e26-483a-a120-7ec176331354" in with_orjson
+
+
+def test_json_output_should_have_spaces_after_separators(monkeypatch):
+    monkeypatch.setattr(json_formatter, "orjson", None)
+    formatter = json_formatter.StackdriverJsonFormatter(timestamp=False)
+    record = logging.LogRecord("test", logging.INFO, __file__, 42, "Hello", (), None)
+
+    assert formatter.format(record).startswith('{"message": "Hello", "funcName": ')
+
+
+def test_should_use_custom_json_encoder(monkeypatch):
+    formatter = json_formatter.StackdriverJsonFormatter(timestamp=False, json_encoder=_DateOnlyJsonEncoder)
+
+    (with_orjson, without_orjson) = _format_with_and_without_orjson(monkeypatch, formatter)
+
+    assert with_orjson == without_orjson
+    assert json.loads(with_orjson)["thing"]["time"] == "2019-12-24"
+
+
+def test_timestamp_should_be_record_creation_time_in_utc():
+    formatter = json_formatter.StackdriverJsonFormatter(timestamp=True)
+
+    for created in [1577836800.0, 1577836800.25, 1577836801.123456, 1577836799.9999996]:
+        record = logging.LogRecord("test", logging.INFO, __file__, 42, "Tick", (), None)
+        record.created = created
+        expected = datetime.fromtimestamp(created, timezone.utc).replace(tzinfo=None).isoformat()
+        assert json.loads(formatter.format(record))["timestamp"] == expected
+
+
+def test_should_handle_huge_integers(capsys):
+    setup_logging()
+
+    with LogContext(huge=2 ** 100):
+        logging.info("Hi, I have a big number.")
+
+    log_json = _readout_json(capsys)
+
+    assert log_json['huge'] == 2 ** 100
+
+
 def test_sigusr1_should_set_info_logging(capsys):
     setup_logging(min_level=logging.ERROR)
     logging.info("Not logged")
@@ -379,6 +826,27 @@ def test_signal_handler_override_should_call_previous_handlers(capsys):
     assert myhandler_run_count == 2
 
 
+def test_repeated_setup_should_call_previous_signal_handlers_once(capsys):
+    myhandler_run_count = 0
+
+    def myhandler(_s, _f):
+        nonlocal myhandler_run_count
+        myhandler_run_count += 1
+
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR2, myhandler)
+
+    for _ in range(3):
+        setup_logging(min_level=logging.WARNING)
+    os.kill(os.getpid(), signal.SIGUSR1)
+    os.kill(os.getpid(), signal.SIGUSR2)
+    logging.debug("Debugged!")
+
+    log_json = _readout_json(capsys)
+    assert log_json['message'] == 'Debugged!'
+    assert myhandler_run_count == 1
+
+
 def test_should_add_commit_it_from_environment(capsys, monkeypatch):
     monkeypatch.setenv('GIT_COMMIT_ID', 'd22b929')
     setup_logging()
@@ -476,3 +944,22 @@ def test_log_exceptions_suppress(capsys):
     assert in_ctx_man['message'] == 'In context manager'
     assert in_ctx['wtf'] == 'bbq'
     assert in_ctx_man['wtf'] == 'bbq'
+
+
+def test_uncaught_exceptions_should_be_logged_where_they_were_raised(capsys):
+    setup_logging()
+
+    def fail():
+        raise ValueError("Uncaught")
+
+    try:
+        fail()
+    except ValueError:
+        sys.excepthook(*sys.exc_info())
+
+    log_json = _readout_json(capsys)
+    assert log_json['message'] == 'Uncaught exception ValueError: Uncaught'
+    assert log_json['severity'] == 'ERROR'
+    assert log_json['funcName'] == 'fail'
+    assert log_json['filename'] == os.path.basename(__file__)
+    assert 'ValueError' in log_json['exc_info']
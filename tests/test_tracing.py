@@ -1,5 +1,7 @@
 import json
-import re
+import logging
+import threading
+from wsgiref.simple_server import make_server, WSGIRequestHandler
 
 import aiohttp
 import pytest
@@ -11,11 +13,38 @@ from starlette.testclient import TestClient
 
 from nivacloud_logging.aiohttp_trace import create_client_trace_config
 from nivacloud_logging.flask_trace import TracingMiddleware
-from nivacloud_logging.log_utils import setup_logging, LogContext
+from nivacloud_logging.log_utils import setup_logging, LogContext, generate_trace_id
 from nivacloud_logging.requests_trace import TracingAdapter
 from nivacloud_logging.starlette_trace import StarletteTracingMiddleware
 
 
+def _echo_headers_app(environ, start_response):
+    # Like http://httpbin.org/headers, which these tests used to depend on.
+    headers = {
+        '-'.join(part.capitalize() for part in key[len('HTTP_'):].split('_')): value
+        for (key, value) in environ.items()
+        if key.startswith('HTTP_')
+    }
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [json.dumps({'headers': headers}).encode()]
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def headers_url():
+    """URL of a local server that responds with the request headers as JSON."""
+    server = make_server('127.0.0.1', 0, _echo_headers_app, handler_class=_QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/headers'
+    server.shutdown()
+    server.server_close()
+
+
 def _create_tracing_requests_session():
     r = requests.Session()
     a = TracingAdapter()
@@ -23,35 +52,48 @@ def _create_tracing_requests_session():
     return r
 
 
+@pytest.fixture(scope="module")
+def tracing_session():
+    # (Shared between tests, so that they reuse the connection pool.)
+    with _create_tracing_requests_session() as session:
+        yield session
+
+
 def _is_trace_like(s):
-    return re.match('[a-f0-9]+', s)
+    return bool(s) and not s.strip('0123456789abcdef')
+
+
+def test_generated_trace_ids_should_be_fixed_length_hex():
+    trace_ids = {generate_trace_id() for _ in range(100)}
+
+    assert len(trace_ids) == 100
+    for trace_id in trace_ids:
+        assert len(trace_id) == 32
+        assert int(trace_id, 16) >= 0
 
 
 # Requests
-def test_requests_generate_span_id_if_missing():
+def test_requests_generate_span_id_if_missing(tracing_session, headers_url):
     setup_logging()
-    session = _create_tracing_requests_session()
-    result = session.get('http://httpbin.org/headers')
+    result = tracing_session.get(headers_url)
     headers = result.json()['headers']
 
     assert 'Span-Id' in headers
     assert _is_trace_like(headers.get('Span-Id'))
 
 
-def test_requests_trace_id_is_picked_up_from_context():
+def test_requests_trace_id_is_picked_up_from_context(tracing_session, headers_url):
     setup_logging()
-    session = _create_tracing_requests_session()
     with LogContext(trace_id='abc123'):
-        result = session.get('http://httpbin.org/headers')
+        result = tracing_session.get(headers_url)
         headers = result.json()['headers']
         assert headers.get('Trace-Id') == 'abc123'
 
 
-def test_requests_trace_id_is_picked_up_from_context():
+def test_requests_user_id_is_picked_up_from_context(tracing_session, headers_url):
     setup_logging()
-    session = _create_tracing_requests_session()
     with LogContext(user_id='10'):
-        result = session.get('http://httpbin.org/headers')
+        result = tracing_session.get(headers_url)
         headers = result.json()['headers']
         assert headers.get('User-Id') == '10'
 
@@ -94,6 +136,24 @@ def test_flask_trace_id_and_userid_is_injected(capsys):
     assert parsed_output2['trace_id'] == response2["Trace-Id"]
 
 
+def test_flask_request_is_not_logged_below_log_level(capsys):
+    app = Flask(__name__)
+    app.wsgi_app = TracingMiddleware(app.wsgi_app)
+
+    setup_logging(min_level=logging.WARNING)
+
+    @app.route("/")
+    def hello():
+        return jsonify({"Trace-Id": LogContext.getcontext("trace_id")})
+
+    client = app.test_client()
+    r = client.get("/", headers={'Trace-Id': '123abc'}).json
+    assert r.get('Trace-Id') == "123abc"
+
+    (out, _) = capsys.readouterr()
+    assert out == ""
+
+
 def test_starlette_trace_id_and_user_id_is_injected(capsys):
     app = Starlette(debug=True)
     app.add_middleware(StarletteTracingMiddleware)
@@ -165,22 +225,44 @@ def test_starlette_span_id_is_generated_if_not_present(capsys):
     assert parsed_output['span_id'] == span_id
 
 
+def test_starlette_exceptions_are_logged_with_context(capsys):
+    app = Starlette()
+    app.add_middleware(StarletteTracingMiddleware)
+
+    setup_logging()
+
+    @app.route("/")
+    async def fail(request):
+        raise ValueError("Starlette failure")
+
+    client = TestClient(app)
+    with pytest.raises(ValueError):
+        client.request(method="GET", url="/", headers={'Trace-Id': 'failingtrace'})
+
+    (out, _) = capsys.readouterr()
+    [request_log, exception_log] = [json.loads(s) for s in out.split("\n") if s][0:2]
+    assert request_log['trace_id'] == 'failingtrace'
+    assert exception_log['message'] == 'Starlette failure'
+    assert exception_log['trace_id'] == 'failingtrace'
+    assert 'ValueError' in exception_log['exc_info']
+
+
 # aiohttp client
 @pytest.mark.asyncio
-async def test_aiohttp_generate_span_id_if_missing():
+async def test_aiohttp_generate_span_id_if_missing(headers_url):
     setup_logging()
     async with aiohttp.ClientSession(trace_configs=[create_client_trace_config()]) as session:
-        async with session.get('http://httpbin.org/headers') as response:
+        async with session.get(headers_url) as response:
             r = await response.json()
             assert _is_trace_like(r['headers'].get('Span-Id'))
 
 
 @pytest.mark.asyncio
-async def test_aiohttp_trace_id_and_user_id_is_picked_up_from_context():
+async def test_aiohttp_trace_id_and_user_id_is_picked_up_from_context(headers_url):
     setup_logging()
     async with aiohttp.ClientSession(trace_configs=[create_client_trace_config()]) as session, \
             LogContext(trace_id='abc123', user_id="5"), \
-            session.get('http://httpbin.org/headers') as response:
+            session.get(headers_url) as response:
         r = await response.json()
         assert r['headers'].get('Trace-Id') == 'abc123'
         assert r['headers'].get('User-Id') == '5'
\ No newline at end of file